@@ -1,18 +1,27 @@
 import os
 import logging
 import json
+import re
 import asyncio
 import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from pyrogram import Client, filters, enums
+from pyrogram.errors import FloodWait, MessageNotModified, RPCError
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaUpload
 
 # Configure logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper()
 )
+# The format doesn't use thread/process info, so skip collecting it per record
+logging.logThreads = False
+logging.logProcesses = False
 logger = logging.getLogger(__name__)
 
 # Environment variables
@@ -22,127 +31,450 @@ BOT_TOKEN = os.environ.get('TELEGRAM_TOKEN')
 TOKEN_JSON = os.environ.get('TOKEN_JSON')
 DRIVE_FOLDER_ID = os.environ.get('DRIVE_FOLDER_ID')
 
+# Resumable chunk size; Drive needs a multiple of 256 KB, which whole MB are.
+# Every running transfer buffers one chunk, so lower it on memory-tight hosts.
+UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_MB', 8)) * 1024 * 1024
+# Retries (with backoff) for 5xx/429 responses on every Drive request
+DRIVE_RETRIES = 3
+# Telegram chunks (1 MB each) buffered between download and upload per transfer
+STREAM_BUFFER_CHUNKS = int(os.environ.get('CHUNK_BUF', 4))
+# Files below this size are sent in a single request (no resumable session)
+SINGLE_REQUEST_MAX_SIZE = 5 * 1024 * 1024
+
+# Concurrent transfers; each one holds an upload thread for its whole duration
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 4))
+UPLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix='drive-up')
+UPLOAD_SEM = asyncio.Semaphore(UPLOAD_WORKERS)
+
+# Fallback when Telegram doesn't send a mime type (e.g. photos)
+_MIME_TYPES = {
+    'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'png': 'image/png',
+    'gif': 'image/gif', 'webp': 'image/webp', 'heic': 'image/heic',
+    'mp4': 'video/mp4', 'mkv': 'video/x-matroska', 'mov': 'video/quicktime',
+    'avi': 'video/x-msvideo', 'webm': 'video/webm',
+    'mp3': 'audio/mpeg', 'm4a': 'audio/mp4', 'm4b': 'audio/mp4',
+    'ogg': 'audio/ogg', 'oga': 'audio/ogg', 'flac': 'audio/flac', 'wav': 'audio/wav',
+    'pdf': 'application/pdf', 'epub': 'application/epub+zip',
+    'zip': 'application/zip', 'rar': 'application/vnd.rar', '7z': 'application/x-7z-compressed',
+    'txt': 'text/plain', 'json': 'application/json',
+}
+
+# Media type -> (message attribute, extension for files Telegram sends unnamed)
+_MEDIA_MAP = {
+    enums.MessageMediaType.DOCUMENT: ("document", ""),
+    enums.MessageMediaType.PHOTO: ("photo", ".jpg"),
+    enums.MessageMediaType.VIDEO: ("video", ".mp4"),
+    enums.MessageMediaType.AUDIO: ("audio", ".mp3"),
+    enums.MessageMediaType.VOICE: ("voice", ".ogg"),
+    enums.MessageMediaType.ANIMATION: ("animation", ".mp4"),
+    enums.MessageMediaType.VIDEO_NOTE: ("video_note", ".mp4"),
+    enums.MessageMediaType.STICKER: ("sticker", ".webp"),
+}
+
+# Anything but letters, digits, '.', '_', '-' and spaces (Unicode letters are kept)
+_FILENAME_RE = re.compile(r'[^\w.\- ]+')
+
+# Seconds between two progress edits of a status message (floodwait)
+PROGRESS_INTERVAL = 5
+# Smaller files (photos, voice notes...) finish too fast for a progress bar
+PROGRESS_MIN_SIZE = 4 * 1024 * 1024
+
 # --- HELPERS ---
+def get_mime_type(filename):
+    ext = os.path.splitext(filename)[1][1:].lower()
+    return _MIME_TYPES.get(ext, 'application/octet-stream')
+
+_SIZE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB', 'PB')
+
 def human_readable_size(size, decimal_places=2):
-    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
-        if size < 1024.0:
-            return f"{size:.{decimal_places}f} {unit}"
-        size /= 1024.0
-    return f"{size:.{decimal_places}f} PB"
+    # Unit index straight from the bit length: every unit is 2**10 bigger
+    i = min(max(int(size).bit_length() - 1, 0) // 10, 5)
+    return f"{size / (1 << (10 * i)):.{decimal_places}f} {_SIZE_UNITS[i]}"
+
+_PROGRESS_BARS = tuple('■' * i + '□' * (10 - i) for i in range(11))
 
 def get_progress_bar_string(current, total):
-    filled_length = int(10 * current // total)
-    return '■' * filled_length + '□' * (10 - filled_length)
-
-async def progress_callback(current, total, message, start_time, file_name):
-    now = time.time()
-    # Update every 5s or at 100% to avoid floodwait
-    if (now - getattr(message, "last_update_time", 0)) > 5 or current == total:
-        elapsed_time = now - start_time
-        if elapsed_time == 0: elapsed_time = 0.1
-        speed = current / elapsed_time
-        percentage = current * 100 / total
-        time_to_completion = (total - current) / speed if speed > 0 else 0
-        eta_str = time.strftime("%M:%S", time.gmtime(time_to_completion))
-        
-        progress_str = (
-            f"📥 **Downloading...**\n"
-            f"📄 `{file_name}`\n"
-            f"[{get_progress_bar_string(current, total)}] {percentage:.1f}%\n"
-            f"⚡ {human_readable_size(speed)}/s | ⏱ ETA: {eta_str}\n"
-            f"💾 {human_readable_size(current)} / {human_readable_size(total)}"
-        )
+    # Clamped: Telegram's file_size can be slightly off from the bytes received
+    return _PROGRESS_BARS[min(10, 10 * current // total)]
+
+def render_progress(current, total, uploaded, elapsed_time, file_name, total_fmt):
+    if elapsed_time == 0: elapsed_time = 0.1
+    speed = current / elapsed_time
+    percentage = current * 100 / total
+    time_to_completion = (total - current) / speed if speed > 0 else 0
+    eta_str = time.strftime("%M:%S", time.gmtime(time_to_completion))
+
+    return (
+        f"🔄 **Transferring...**\n"
+        f"📄 `{file_name}`\n"
+        f"[{get_progress_bar_string(current, total)}] {percentage:.1f}%\n"
+        f"⚡ {human_readable_size(speed)}/s | ⏱ ETA: {eta_str}\n"
+        f"💾 {human_readable_size(current)} / {total_fmt}\n"
+        f"☁️ In Drive: {human_readable_size(uploaded)}"
+    )
+
+def progress_callback(current, total, state):
+    # Only record the latest numbers in the transfer's own state dict
+    # (created in transfer_media); progress_updater renders and sends them
+    state['current'] = current
+    state['total'] = total
+
+def upload_progress_callback(uploaded, state):
+    # Runs in the upload thread; picked up by progress_updater on its next tick
+    state['uploaded'] = uploaded
+
+async def progress_updater(message, state, start_time, file_name):
+    # One task per transfer. Every PROGRESS_INTERVAL it sends only the latest
+    # progress, so stale updates never pile up behind flood limits.
+    loop = asyncio.get_running_loop()
+    # The total doesn't change during a transfer; format it once
+    total_fmt = human_readable_size(state['total'])
+    sent = None
+    last_text = None
+    while True:
+        await asyncio.sleep(PROGRESS_INTERVAL)
+        latest = (state['current'], state['total'], state['uploaded'])
+        if latest == sent:
+            continue
+        sent = latest
+        text = render_progress(*latest, loop.time() - start_time, file_name, total_fmt)
+        # Rounding can render the same text twice; don't spend an RPC on it
+        if text == last_text:
+            continue
         try:
-            await message.edit_text(progress_str)
-            message.last_update_time = now
-        except Exception:
-            pass
+            await message.edit_text(text)
+            last_text = text
+        except MessageNotModified:
+            last_text = text
+        except FloodWait as e:
+            # Longer than the client's sleep_threshold; back off before the next edit
+            await asyncio.sleep(e.value)
+        except RPCError as e:
+            logger.warning("Progress update failed: %s", e)
+        except Exception as e:
+            # Transport errors (dropped connection, timeouts) aren't RPCErrors;
+            # keep the updater alive for the rest of the transfer
+            logger.warning("Progress update failed: %r", e)
 
 # --- GOOGLE DRIVE STUFF ---
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+# Credentials are parsed once; each upload thread keeps its own service and
+# keep-alive connection because googleapiclient/httplib2 objects are not
+# thread-safe.
+_credentials = None
+_credentials_lock = threading.Lock()
+_drive_local = threading.local()
+
+def get_credentials():
+    global _credentials
+    with _credentials_lock:
+        if _credentials is None:
+            # Load User Token
+            token_info = json.loads(TOKEN_JSON)
+            _credentials = Credentials.from_authorized_user_info(token_info)
+        return _credentials
+
 def get_drive_service():
+    service = getattr(_drive_local, "service", None)
+    if service is not None:
+        return service
     try:
-        # Load User Token
-        token_info = json.loads(TOKEN_JSON)
-        creds = Credentials.from_authorized_user_info(token_info)
-        return build('drive', 'v3', credentials=creds)
-    except Exception as e:
-        logger.error(f"Error creating Drive service: {e}")
+        # static_discovery uses the discovery doc bundled with the library (no HTTP fetch)
+        service = build('drive', 'v3', credentials=get_credentials(),
+                        cache_discovery=False, static_discovery=True)
+    except Exception:
+        logger.exception("Error creating Drive service")
         return None
+    _drive_local.service = service
+    return service
+
+class TelegramMediaUpload(MediaUpload):
+    # Resumable media body fed with chunks as they arrive from Telegram, so the
+    # file never touches the disk. The event loop calls feed()/close()/abort(),
+    # the upload thread pulls bytes through getbytes(). The queue in between is
+    # bounded: when Drive is slower than Telegram, feed() waits instead of
+    # buffering the whole file in memory.
+    def __init__(self, size, mimetype, chunksize=UPLOAD_CHUNK_SIZE):
+        super().__init__()
+        self._size = size
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=STREAM_BUFFER_CHUNKS)
+        self._buffer = bytearray()
+        self._offset = 0  # stream position of self._buffer[0]
+        self._eof = False
+        self._closed = False
+        self._aborted = False
+        self._discarding = False
+
+    async def feed(self, chunk):
+        if not self._discarding:
+            await self._queue.put(chunk)
+
+    async def close(self):
+        if not self._discarding:
+            await self._queue.put(None)
+        # Only once the EOF marker is queued; a cancelled put must still abort
+        self._closed = True
+
+    def abort(self):
+        # Fail the upload instead of letting Drive finalize a truncated file.
+        # No-op after close(): the reader just finishes the complete stream.
+        if self._closed:
+            return
+        self._aborted = True
+        try:
+            self._queue.put_nowait(None)  # wakes a reader waiting on an empty queue
+        except asyncio.QueueFull:
+            pass  # the reader isn't waiting and checks the flag before its next get
+
+    def discard(self):
+        # The upload ended, so nothing reads the queue anymore: drop what's
+        # buffered and make further feed()/close() calls no-ops.
+        self._discarding = True
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        return self._size
+
+    def resumable(self):
+        return self._size is None or self._size >= SINGLE_REQUEST_MAX_SIZE
 
-def upload_to_drive(file_path, file_name, mime_type='application/octet-stream'):
+    def _get(self):
+        # Never wait blindly: if the loop stops mid-transfer (e.g. shutdown) the
+        # get would never complete, leaking this pool thread and hanging exit
+        future = asyncio.run_coroutine_threadsafe(self._queue.get(), self._loop)
+        while True:
+            try:
+                return future.result(timeout=1)
+            except FutureTimeoutError:
+                if self._aborted or not self._loop.is_running():
+                    future.cancel()
+                    raise IOError("Telegram stream aborted")
+
+    def getbytes(self, begin, length):
+        # Bytes before `begin` are acknowledged by Drive; the rest stays
+        # buffered in case the chunk has to be re-sent.
+        del self._buffer[:begin - self._offset]
+        self._offset = begin
+        while len(self._buffer) < length and not self._eof:
+            if self._aborted:
+                raise IOError("Telegram stream aborted")
+            item = self._get()
+            if item is None:
+                if self._aborted:
+                    raise IOError("Telegram stream aborted")
+                self._eof = True
+            else:
+                self._buffer += item
+        return bytes(self._buffer[:length])
+
+# Folder name -> Drive folder id (LRU, capped), so files sharing a base name
+# (e.g. the parts of an audiobook) reuse one folder instead of creating a new
+# one each time
+FOLDER_CACHE_SIZE = 256
+_folder_ids = OrderedDict()
+_folder_ids_lock = threading.Lock()
+# Striped locks: uploads into the same new folder never create it twice, while
+# lookups for most unrelated names still run in parallel
+_folder_locks = tuple(threading.Lock() for _ in range(16))
+
+def get_folder_id(service, folder_name):
+    with _folder_locks[hash(folder_name) % len(_folder_locks)]:
+        with _folder_ids_lock:
+            folder_id = _folder_ids.get(folder_name)
+            if folder_id:
+                _folder_ids.move_to_end(folder_name)
+                return folder_id
+
+        # Look for an existing folder first
+        escaped_name = folder_name.replace('\\', '\\\\').replace("'", "\\'")
+        found = service.files().list(
+            q=f"name = '{escaped_name}' and mimeType = '{FOLDER_MIME_TYPE}' "
+              f"and '{DRIVE_FOLDER_ID}' in parents and trashed = false",
+            fields='files(id)',
+            pageSize=1
+        ).execute(num_retries=DRIVE_RETRIES).get('files', [])
+
+        if found:
+            folder_id = found[0]['id']
+        else:
+            folder_metadata = {
+                'name': folder_name,
+                'mimeType': FOLDER_MIME_TYPE,
+                'parents': [DRIVE_FOLDER_ID]
+            }
+            folder = service.files().create(
+                body=folder_metadata,
+                fields='id'
+            ).execute(num_retries=DRIVE_RETRIES)
+            folder_id = folder.get('id')
+
+        with _folder_ids_lock:
+            _folder_ids[folder_name] = folder_id
+            if len(_folder_ids) > FOLDER_CACHE_SIZE:
+                _folder_ids.popitem(last=False)
+        return folder_id
+
+def upload_to_drive(media_body, file_name, progress=None, progress_args=()):
+    # 1. Folder based on filename (e.g. "Dune.m4b" -> Folder "Dune")
+    folder_name = os.path.splitext(file_name)[0]
     try:
         service = get_drive_service()
         if not service: return None
+
+        specific_folder_id = get_folder_id(service, folder_name)
         
-        # 1. Create a Folder based on filename (e.g. "Dune.m4b" -> Folder "Dune")
-        folder_name = os.path.splitext(file_name)[0]
-        
-        folder_metadata = {
-            'name': folder_name,
-            'mimeType': 'application/vnd.google-apps.folder',
-            'parents': [DRIVE_FOLDER_ID]
-        }
-        
-        # Create the folder
-        folder = service.files().create(
-            body=folder_metadata, 
-            fields='id'
-        ).execute()
-        
-        specific_folder_id = folder.get('id')
-        
-        # 2. Upload file INSIDE that new folder
+        # 2. Upload file INSIDE that folder
         file_metadata = {
             'name': file_name,
             'parents': [specific_folder_id]
         }
         
-        media = MediaFileUpload(file_path, mimetype=mime_type, resumable=True)
-        
-        file = service.files().create(
+        request = service.files().create(
             body=file_metadata,
-            media_body=media,
+            media_body=media_body,
             fields='id, name, webViewLink, size'
-        ).execute()
+        )
+        if not media_body.resumable():
+            return request.execute(num_retries=DRIVE_RETRIES)
+        file = None
+        while file is None:
+            status, file = request.next_chunk(num_retries=DRIVE_RETRIES)
+            if status and progress:
+                progress(status.resumable_progress, *progress_args)
         return file
     except Exception as e:
-        logger.error(f"Error uploading to Drive: {e}")
+        # A 404 means the cached folder was deleted on Drive; look it up again
+        # next time. Other failures (network, quota) leave the cache alone
+        if isinstance(e, HttpError) and e.resp.status == 404:
+            with _folder_ids_lock:
+                _folder_ids.pop(folder_name, None)
+        logger.exception("Drive upload failed for %s", file_name)
         return None
 
 # --- BOT CODE ---
-app = Client("bot_session", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+# uvloop speeds up the socket-heavy Telegram transfers. It has to be installed
+# before the Client grabs its event loop; not available on Windows.
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
+# A transfer keeps its Telegram transmission slot until it is done, so allow
+# one transmission per upload worker (Pyrogram defaults to 1)
+app = Client(
+    "bot_session",
+    api_id=API_ID,
+    api_hash=API_HASH,
+    bot_token=BOT_TOKEN,
+    max_concurrent_transmissions=UPLOAD_WORKERS,
+    sleep_threshold=60
+)
 
 @app.on_message(filters.command("start"))
 async def start(client, message):
-    await message.reply_text("👋 **Ready!**\nSend files -> I'll create a folder & upload them.")
+    await message.reply_text("👋 **Ready!**\nSend files -> I'll upload each one into a folder named after it.")
+
+# Running transfer tasks; asyncio only keeps weak references to tasks
+_transfers = set()
 
 @app.on_message(filters.media)
 async def handle_media(client, message):
-    media = getattr(message, message.media.value)
-    file_name = getattr(media, "file_name", None) or f"{message.media.value}_{message.id}"
-    # Sanitize filename
-    file_name = "".join([c for c in file_name if c.isalpha() or c.isdigit() or c in "._- "]).strip()
+    entry = _MEDIA_MAP.get(message.media)
+    if entry is None:
+        # Polls, locations, contacts... have no file to upload
+        await message.reply_text("❌ Unsupported media type.")
+        return
+    attr, ext = entry
+    media = getattr(message, attr)
+    file_name = getattr(media, "file_name", None) or ""
+    # Sanitize filename; generate one if Telegram sent none or nothing is left
+    file_name = _FILENAME_RE.sub('', file_name).strip() or f"{attr}_{message.id}{ext}"
 
-    status_msg = await message.reply_text(f"⏳ **Starting...**\n`{file_name}`")
-    status_msg.last_update_time = 0
-    start_time = time.time()
-    local_path = f"downloads/{file_name}"
+    # All transfer slots busy: say so instead of looking stuck
+    queued = UPLOAD_SEM.locked()
+    status_text = "⏳ **Queued...**" if queued else "⏳ **Starting...**"
+    status_msg = await message.reply_text(f"{status_text}\n`{file_name}`")
 
-    try:
-        # Download
-        await message.download(
-            file_name=local_path,
-            progress=progress_callback,
-            progress_args=(status_msg, start_time, file_name)
+    # Run the transfer as its own task: a queued file would otherwise hold one
+    # of Pyrogram's handler workers while it waits for an upload slot, and
+    # enough of them would stall every other update (including /start)
+    task = asyncio.create_task(transfer_media(client, message, media, file_name, status_msg, queued))
+    _transfers.add(task)
+    task.add_done_callback(_transfers.discard)
+
+async def transfer_media(client, message, media, file_name, status_msg, queued):
+    loop = asyncio.get_running_loop()
+
+    mime_type = getattr(media, "mime_type", None) or get_mime_type(file_name)
+    total = getattr(media, "file_size", None) or None
+    progress_state = {'current': 0, 'total': total, 'uploaded': 0}
+    media_body = TelegramMediaUpload(total, mime_type)
+
+    def start_upload():
+        future = loop.run_in_executor(
+            UPLOAD_EXECUTOR, upload_to_drive, media_body, file_name,
+            upload_progress_callback, (progress_state,)
         )
-        
-        await status_msg.edit_text(f"☁️ **Uploading to new folder...**\n📄 `{file_name}`")
-        
-        mime_type = getattr(media, "mime_type", "application/octet-stream")
-        
-        # Upload
-        loop = asyncio.get_running_loop()
-        result = await loop.run_in_executor(None, upload_to_drive, local_path, file_name, mime_type)
+        # Once the upload ends nobody reads the stream; don't let feed() block on it
+        future.add_done_callback(lambda _: media_body.discard())
+        return future
+
+    upload = None
+    progress_task = None
+    show_progress = total is not None and total >= PROGRESS_MIN_SIZE
+
+    try:
+        async with UPLOAD_SEM:
+            if queued:
+                await status_msg.edit_text(f"⏳ **Starting...**\n`{file_name}`")
+            # Timed from here so waiting for a slot doesn't skew speed/ETA
+            start_time = loop.time()
+            if show_progress:
+                progress_task = asyncio.create_task(progress_updater(status_msg, progress_state, start_time, file_name))
+            # Stream: Telegram chunks go straight into the Drive resumable upload.
+            # The upload (and its folder) only starts once Telegram sends data.
+            current = 0
+            async for chunk in client.stream_media(message):
+                if upload is not None and upload.done():
+                    break  # upload failed, stop downloading; reported below
+                current += len(chunk)
+                if total is not None and current > total:
+                    raise IOError(f"Telegram sent more than the expected {total} bytes")
+                if upload is None:
+                    upload = start_upload()
+                await media_body.feed(chunk)
+                if show_progress:
+                    progress_callback(current, total, progress_state)
+            else:
+                # Pyrogram's get_file() logs Telegram errors and just ends the
+                # stream, so check it's complete before letting Drive finalize it
+                # (raising leaves the upload to be aborted in finally)
+                if upload is None:
+                    raise IOError("Telegram sent no data")
+                if total is not None and current != total:
+                    raise IOError(f"Telegram stream ended early ({current} of {total} bytes)")
+                await media_body.close()
+            if progress_task:
+                progress_task.cancel()
+
+            # Small uploads finish right away; only announce the last step if
+            # it takes a while, saving an edit right before the final one
+            done, _ = await asyncio.wait({upload}, timeout=1)
+            if not done:
+                await status_msg.edit_text(f"☁️ **Uploading to Drive folder...**\n📄 `{file_name}`")
+            result = await upload
 
         if result:
             size_fmt = human_readable_size(int(result.get('size', 0)))
@@ -159,11 +491,13 @@ async def handle_media(client, message):
             await status_msg.edit_text("❌ Upload failed. Check Railway logs.")
 
     except Exception as e:
+        logger.exception("Media transfer failed for msg %s", message.id)
         await status_msg.edit_text(f"❌ Error: {str(e)}")
     finally:
-        if os.path.exists(local_path): os.remove(local_path)
+        if progress_task:
+            progress_task.cancel()
+        media_body.abort()
 
 if __name__ == '__main__':
-    if not os.path.exists("downloads"): os.makedirs("downloads")
     app.run()
     